@@ -0,0 +1,33 @@
+# Конфигурация gunicorn для production: gunicorn -c gunicorn.conf.py main:app
+# (python main.py запускает встроенный сервер Flask и подходит только для разработки).
+#
+# В production обработка видео выполняется воркерами Celery (CELERY_BROKER_URL):
+# обработчики только ставят задачи в очередь и читают статус, поэтому gevent-воркеры
+# держат много одновременных запросов.
+#
+# Без Celery задачи обрабатываются потоками внутри веб-воркера. Под gevent эти потоки
+# становятся гринлетами, и блокирующее распознавание речи (CTranslate2) останавливает
+# цикл событий воркера: запросы не обслуживаются, heartbeat не отправляется, и по
+# timeout gunicorn убивает воркер вместе с задачей. Поэтому в этом режиме используется
+# один воркер с обычными потоками (gthread) и длинным timeout: CONCURRENT_JOBS,
+# MAX_QUEUE и модель Whisper рассчитаны на один процесс.
+import multiprocessing
+import os
+import sys
+
+bind = os.getenv("BIND", "0.0.0.0:9000")
+
+if os.getenv("CELERY_BROKER_URL"):
+    worker_class = "gevent"
+    workers = int(os.getenv("WEB_CONCURRENCY", multiprocessing.cpu_count() * 2 + 1))
+    worker_connections = 1000
+    timeout = 30
+else:
+    sys.stderr.write(
+        "WARNING: CELERY_BROKER_URL не задан - видео обрабатывается внутри веб-сервера. "
+        "Запуск с одним gthread-воркером; для production настройте Celery.\n"
+    )
+    worker_class = "gthread"
+    workers = 1
+    threads = int(os.getenv("GUNICORN_THREADS", "8"))
+    timeout = 300
@@ -1,44 +1,368 @@
-from flask import Flask, request, jsonify, send_file
+from flask import Flask, request, jsonify, make_response
+from flask.json.provider import DefaultJSONProvider
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.wsgi import wrap_file
 import json
 import uuid
 import os
 import threading
 import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from concurrent.futures import ThreadPoolExecutor
 import ffmpeg
-import pysrt
 from datetime import datetime
 from urllib.parse import urlparse
 import tempfile
 import re
 import subprocess
 import sys
+import logging
+import logging.handlers
+import queue
+import atexit
+
+# Журналирование: запись лога только кладется в очередь, вывод в stderr
+# выполняет фоновый поток QueueListener, поэтому обработчики запросов не ждут друг друга
+_LOG_QUEUE = queue.Queue(-1)
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [%(name)s] %(message)s"))
+_LOG_LISTENER = logging.handlers.QueueListener(_LOG_QUEUE, _log_stream_handler)
+_log_queue_handler = logging.handlers.QueueHandler(_LOG_QUEUE)
+_log_queue_handler.setFormatter(logging.Formatter("%(message)s"))
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "INFO").upper(), handlers=[_log_queue_handler])
+_LOG_LISTENER.start()
+atexit.register(_LOG_LISTENER.stop)
+logger = logging.getLogger('webhook')
 
 # Импорты для создания прокручивающихся субтитров
 try:
     import whisper
+    import numpy as np
     from faster_whisper import WhisperModel
     WHISPER_AVAILABLE = True
 except ImportError:
     WHISPER_AVAILABLE = False
-    print("Warning: Whisper не установлен. Автоматическое создание субтитров недоступно.")
+    logger.warning("Whisper не установлен. Автоматическое создание субтитров недоступно.")
+
+# Очередь задач Celery (опционально): включается переменной CELERY_BROKER_URL
+try:
+    from celery import Celery, chain
+    from kombu.exceptions import ChannelError
+    CELERY_AVAILABLE = True
+except ImportError:
+    CELERY_AVAILABLE = False
+
+# Хранилище состояния задач в Redis (опционально): включается переменной REDIS_URL
+try:
+    import redis
+    REDIS_AVAILABLE = True
+except ImportError:
+    REDIS_AVAILABLE = False
+
+# Быстрый JSON-парсер (опционально)
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+class OrjsonProvider(DefaultJSONProvider):
+    """JSON-провайдер Flask на orjson: jsonify и request.json без изменений в маршрутах"""
+    def dumps(self, obj, **kwargs):
+        option = orjson.OPT_NON_STR_KEYS
+        if kwargs.get("sort_keys", self.sort_keys):
+            option |= orjson.OPT_SORT_KEYS
+        return orjson.dumps(obj, default=self.default, option=option).decode()
+    
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
 
 app = Flask(__name__)
+if ORJSON_AVAILABLE:
+    app.json = OrjsonProvider(app)
+# Ограничение размера тела webhook (JSON со списком видео и SRT)
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("MAX_CONTENT_LENGTH", str(2 * 1024 * 1024)))
 
 # Конфигурация
+# Режим отладки Flask (отладчик Werkzeug и перезагрузчик) только явно: FLASK_DEBUG=1
+DEBUG = os.getenv("FLASK_DEBUG") == "1"
 TEMP_DIR = "temp_files"
 OUTPUT_DIR = "output_videos"
 TASKS = {}
+IDEMPOTENCY_KEYS = {}
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# libx264 плохо масштабируется дальше ~4 потоков: выгоднее несколько параллельных
+# кодирований с ограниченным числом потоков, чем одно на все ядра
+FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "4"))
+CONCURRENT_JOBS = int(os.getenv("CONCURRENT_JOBS", str(max(1, (os.cpu_count() or 1) // FFMPEG_THREADS))))
+# Сверх MAX_QUEUE ожидающих задач webhook отвечает 429, чтобы не исчерпать память кодированием
+MAX_QUEUE = int(os.getenv("MAX_QUEUE", str(CONCURRENT_JOBS * 4)))
+
+CELERY_BROKER_URL = os.getenv("CELERY_BROKER_URL")
+CELERY_RESULT_BACKEND = os.getenv("CELERY_RESULT_BACKEND", CELERY_BROKER_URL)
+
+# По умолчанию состояние задач хранится в том же Redis, что служит брокером Celery
+REDIS_URL = os.getenv("REDIS_URL")
+if not REDIS_URL and CELERY_BROKER_URL and CELERY_BROKER_URL.startswith(("redis://", "rediss://")):
+    REDIS_URL = CELERY_BROKER_URL
+TASK_TTL = 24 * 3600
+
+# Отдача готовых файлов через nginx (X-Accel-Redirect): внутренний location,
+# указывающий на OUTPUT_DIR, например "/_protected/". Пусто - файл отдает Flask
+X_ACCEL_REDIRECT_PREFIX = os.getenv("X_ACCEL_REDIRECT_PREFIX", "")
+
+# Готовый файл задачи не меняется, поэтому /download можно кэшировать (в том числе CDN)
+# на время жизни задачи; /status меняется по ходу обработки и не кэшируется
+DOWNLOAD_CACHE_CONTROL = f"public, max-age={TASK_TTL}, immutable"
 
 # Создание директорий
 os.makedirs(TEMP_DIR, exist_ok=True)
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
+celery = None
+if CELERY_BROKER_URL:
+    if CELERY_AVAILABLE:
+        celery = Celery('video', broker=CELERY_BROKER_URL, backend=CELERY_RESULT_BACKEND)
+        celery.conf.worker_concurrency = CONCURRENT_JOBS
+    else:
+        logger.warning("Задан CELERY_BROKER_URL, но Celery не установлен. Задачи выполняются в потоках.")
+
+redis_client = None
+if REDIS_URL:
+    if REDIS_AVAILABLE:
+        redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    else:
+        logger.warning("Задан REDIS_URL, но пакет redis не установлен. Задачи хранятся в памяти процесса.")
+
+# Этапы Celery пишут состояние задачи из процессов воркеров: без общего хранилища
+# веб-процесс навсегда остался бы со статусом "initiated"
+if celery is not None and redis_client is None:
+    raise RuntimeError(
+        "Celery требует Redis для состояния задач: задайте REDIS_URL "
+        "(или брокер redis://) и установите пакет redis"
+    )
+
+def detect_nvenc():
+    """Проверка доступности аппаратного кодировщика h264_nvenc (один раз при запуске)"""
+    try:
+        encoders = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-encoders'],
+            capture_output=True, text=True, timeout=15
+        ).stdout
+        if 'h264_nvenc' not in encoders:
+            return False
+        # Кодировщик может быть собран в ffmpeg, но без GPU он не запустится
+        test_encode = subprocess.run(
+            ['ffmpeg', '-hide_banner', '-f', 'lavfi', '-i', 'nullsrc=s=256x256',
+             '-frames:v', '1', '-c:v', 'h264_nvenc', '-f', 'null', '-'],
+            capture_output=True, timeout=30
+        )
+        return test_encode.returncode == 0
+    except Exception:
+        return False
+
+NVENC_AVAILABLE = detect_nvenc()
+if NVENC_AVAILABLE:
+    logger.info("NVENC доступен: кодирование видео будет выполняться на GPU")
+
+# Заголовок ASS субтитров: стиль Default для обычных строк, Karaoke для подсветки слов
+_ASS_HEADER = """[Script Info]
+Title: Scrolling Subtitles
+ScriptType: v4.00+
+
+[V4+ Styles]
+Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
+Style: Default,Arial,32,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,1,0,0,0,100,100,0,0,1,2,3,2,30,30,50,1
+Style: Karaoke,Arial,32,&H0000FFFF,&H00FFFFFF,&H00000000,&H80000000,1,0,0,0,100,100,0,0,1,2,3,2,30,30,50,1
+
+[Events]
+Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
+"""
+
+# Состояние задач: пишется из потоков или воркеров обработки, читается из обработчиков Flask.
+# С Redis каждая задача - хэш task:<id> с TTL, общий для всех процессов; без Redis -
+# словарь TASKS в памяти процесса. Значения полей в Redis хранятся в JSON
+TASKS_LOCK = threading.Lock()
+
+def _task_key(task_id):
+    return f"task:{task_id}"
+
+def create_task(task_id, task_info):
+    """Регистрация новой задачи"""
+    if redis_client is not None:
+        key = _task_key(task_id)
+        pipe = redis_client.pipeline()
+        pipe.delete(key)
+        pipe.hset(key, mapping={field: json.dumps(value) for field, value in task_info.items()})
+        pipe.expire(key, TASK_TTL)
+        pipe.execute()
+        return
+    
+    with TASKS_LOCK:
+        TASKS[task_id] = dict(task_info)
+
+def update_task(task_id, **fields):
+    """Атомарное обновление полей задачи"""
+    if redis_client is not None:
+        key = _task_key(task_id)
+        pipe = redis_client.pipeline()
+        pipe.hset(key, mapping={field: json.dumps(value) for field, value in fields.items()})
+        pipe.expire(key, TASK_TTL)
+        pipe.execute()
+        return
+    
+    with TASKS_LOCK:
+        TASKS.setdefault(task_id, {}).update(fields)
+
+def get_task(task_id):
+    """Копия состояния задачи или None, если задача не найдена"""
+    if redis_client is not None:
+        task_info = redis_client.hgetall(_task_key(task_id))
+        if not task_info:
+            return None
+        return {field: json.loads(value) for field, value in task_info.items()}
+    
+    with TASKS_LOCK:
+        task_info = TASKS.get(task_id)
+        return dict(task_info) if task_info is not None else None
+
+def get_task_fields(task_id, *fields):
+    """Только указанные поля задачи (без чтения остальных) или None, если задача не найдена"""
+    if redis_client is not None:
+        values = redis_client.hmget(_task_key(task_id), fields)
+        if all(value is None for value in values):
+            return None
+        return {field: json.loads(value) if value is not None else None
+                for field, value in zip(fields, values)}
+    
+    with TASKS_LOCK:
+        task_info = TASKS.get(task_id)
+        if task_info is None:
+            return None
+        return {field: task_info.get(field) for field in fields}
+
+def claim_idempotency_key(key, task_id):
+    """Привязка Idempotency-Key к новой задаче на TASK_TTL.
+    Возвращает task_id задачи, уже созданной с этим ключом, или None, если ключ свободен"""
+    if redis_client is not None:
+        redis_key = f"idem:{key}"
+        if redis_client.set(redis_key, task_id, nx=True, ex=TASK_TTL):
+            return None
+        return redis_client.get(redis_key)
+    
+    now = time.time()
+    with TASKS_LOCK:
+        # TTL одинаковый, поэтому порядок вставки совпадает с порядком истечения:
+        # устаревшие ключи вытесняются с начала словаря
+        while IDEMPOTENCY_KEYS:
+            oldest_key = next(iter(IDEMPOTENCY_KEYS))
+            if IDEMPOTENCY_KEYS[oldest_key][1] > now:
+                break
+            del IDEMPOTENCY_KEYS[oldest_key]
+        
+        existing = IDEMPOTENCY_KEYS.get(key)
+        if existing is not None:
+            return existing[0]
+        IDEMPOTENCY_KEYS[key] = (task_id, now + TASK_TTL)
+        return None
+
+def release_idempotency_key(key, task_id):
+    """Снятие привязки Idempotency-Key, если она еще указывает на task_id (задача не создана)"""
+    if redis_client is not None:
+        redis_client.eval(
+            "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0",
+            1, f"idem:{key}", task_id
+        )
+        return
+    
+    with TASKS_LOCK:
+        existing = IDEMPOTENCY_KEYS.get(key)
+        if existing is not None and existing[0] == task_id:
+            del IDEMPOTENCY_KEYS[key]
+
+# Регулярные выражения для очистки текста описаний
+TECH_TERMS = ['POV', 'GoPro', 'MacBook', 'LinkedIn', 'TikTok', 'iPhone camera']
+_URL_RE = re.compile(r'https?://\S+')
+_TECH_TERMS_RE = re.compile(r'\b(?:' + '|'.join(map(re.escape, TECH_TERMS)) + r')\b', re.IGNORECASE)
+_REALISTIC_RE = re.compile(r'realistic and casual.*', re.IGNORECASE)
+_FPV_RE = re.compile(r'first person view.*?shot of', re.IGNORECASE)
+_WS_RE = re.compile(r'\s+')
+
+# Один проход по SRT: таймкоды и текст каждой реплики (текст может быть пустым)
+# Реплики привязаны к началу строки, а содержимое обрезается справа заранее:
+# иначе длинные серии цифр или пробелов разбираются за квадратичное время
+_SRT_CUE_RE = re.compile(
+    r'^(\d+):(\d{2}):(\d{2})[,.](\d{1,3})[ \t]*-->[ \t]*(\d+):(\d{2}):(\d{2})[,.](\d{1,3})[^\n]*'
+    r'(?:\n(.*?))??(?=\n[ \t]*\n|\Z)',
+    re.DOTALL | re.MULTILINE
+)
+
+def parse_srt_content(content):
+    """Парсинг текста SRT в список строк {'text', 'start', 'end'} со временем в секундах"""
+    content = content.lstrip('\ufeff').replace('\r\n', '\n').replace('\r', '\n').rstrip()
+    line_level_subtitles = []
+    
+    for match in _SRT_CUE_RE.finditer(content):
+        (start_h, start_m, start_s, start_ms,
+         end_h, end_m, end_s, end_ms, text) = match.groups()
+        
+        line_level_subtitles.append({
+            'text': (text or '').strip().replace('\n', ' '),
+            'start': int(start_h) * 3600 + int(start_m) * 60 + int(start_s) + int(start_ms.ljust(3, '0')) / 1000.0,
+            'end': int(end_h) * 3600 + int(end_m) * 60 + int(end_s) + int(end_ms.ljust(3, '0')) / 1000.0
+        })
+    
+    return line_level_subtitles
+
+# Модель Whisper загружается один раз на процесс
+_WHISPER_MODEL = None
+_WHISPER_MODEL_LOCK = threading.Lock()
+_TRANSCRIBE_SEMAPHORE = threading.Semaphore(1)
+
+def whisper_cpu_threads():
+    """Число потоков CTranslate2 на процесс в пределах общего бюджета ядер"""
+    cpu_count = os.cpu_count() or 2
+    if celery is not None:
+        # Каждый из CONCURRENT_JOBS процессов воркера грузит свою модель и свой
+        # семафор, поэтому ядра делятся между процессами поровну
+        return max(1, cpu_count // CONCURRENT_JOBS)
+    return max(1, cpu_count // 2)
+
+def get_whisper_model():
+    """Ленивая инициализация квантованной модели Whisper (int8 на CPU, int8_float16 на GPU)"""
+    global _WHISPER_MODEL
+    if _WHISPER_MODEL is None:
+        with _WHISPER_MODEL_LOCK:
+            if _WHISPER_MODEL is None:
+                try:
+                    import ctranslate2
+                    has_cuda = ctranslate2.get_cuda_device_count() > 0
+                except Exception:
+                    has_cuda = False
+                
+                if has_cuda:
+                    _WHISPER_MODEL = WhisperModel("base", device="cuda", compute_type="int8_float16")
+                else:
+                    _WHISPER_MODEL = WhisperModel("base", device="cpu", compute_type="int8",
+                                                  cpu_threads=whisper_cpu_threads())
+    return _WHISPER_MODEL
+
 class VideoDownloader:
     """Класс для загрузки видео с xAPI заголовками"""
     
     def __init__(self):
         self.session = requests.Session()
+        # Пул соединений под параллельную загрузку частей видео и повтор при ошибках CDN
+        adapter = HTTPAdapter(
+            pool_connections=16,
+            pool_maxsize=16,
+            max_retries=Retry(total=3, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
         # Установка базовых заголовков для xAPI
         self.session.headers.update({
             'User-Agent': 'xAPI-Video-Processor/1.0',
@@ -57,155 +381,269 @@ class VideoDownloader:
             response = self.session.get(video_url, headers=headers, stream=True)
             response.raise_for_status()
             
-            with open(output_path, 'wb') as f:
-                for chunk in response.iter_content(chunk_size=8192):
+            with open(output_path, 'wb', buffering=DOWNLOAD_CHUNK_SIZE) as f:
+                for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
                     if chunk:
                         f.write(chunk)
             
             return True
             
         except Exception as e:
-            print(f"Ошибка загрузки видео {video_url}: {e}")
+            logger.error(f"Ошибка загрузки видео {video_url}: {e}")
             return False
 
 class VideoProcessor:
-    def __init__(self, task_id, video_data, subtitles_content=None):
+    def __init__(self, task_id, video_data, subtitle_cues=None):
         self.task_id = task_id
         self.video_data = video_data
-        self.subtitles_content = subtitles_content
+        self.subtitle_cues = subtitle_cues
         self.status = "processing"
         self.progress = 0
         self.downloader = VideoDownloader()
+        self._probe_cache = {}
         
     def process_videos(self):
-        """Основная функция обработки видео"""
+        """Основная функция обработки видео: этапы выполняются последовательно в текущем потоке"""
+        state = self.run_stage(self.download_stage)
+        if state is not None:
+            state = self.run_stage(self.subtitles_stage, state)
+        if state is not None:
+            self.run_stage(self.encode_stage, state)
+
+    def run_stage(self, stage, *args):
+        """Выполнение этапа обработки; при ошибке задача помечается как error и возвращается None"""
         try:
-            TASKS[self.task_id]["status"] = "processing"
-            self.progress = 0
-            TASKS[self.task_id]["progress"] = self.progress
-            
-            # Шаг 1: Загрузка и объединение видео частей (20%)
-            combined_video_path = self.download_and_combine_videos()
-            if not combined_video_path:
-                TASKS[self.task_id]["status"] = "error"
-                TASKS[self.task_id]["error"] = "Failed to download and combine videos."
-                return
-            self.progress = 20
-            TASKS[self.task_id]["progress"] = self.progress
-
-            # Шаг 2: Проверка наличия аудио
-            has_audio = self.check_audio_exists(combined_video_path)
-            
-            # Шаг 3: Обработка субтитров (50%)
-            word_level_info = None
-            line_level_subtitles = None
-            
-            if has_audio and WHISPER_AVAILABLE:
-                # Извлечение аудио и создание субтитров с временными метками слов
-                word_level_info = self.extract_word_timestamps(combined_video_path)
-                if word_level_info:
-                    line_level_subtitles = self.convert_to_line_level(word_level_info)
-                    print(f"Задача {self.task_id}: Создано {len(line_level_subtitles)} строк субтитров из аудио")
-            
-            # Если аудио нет или нет word_level_info, используем SRT из webhook
-            if not word_level_info and self.subtitles_content:
-                subtitles_path = self.save_subtitles_from_webhook(self.subtitles_content)
-                line_level_subtitles = self.parse_srt_to_line_level(subtitles_path)
-                print(f"Задача {self.task_id}: Используются субтитры из webhook")
-            
-            # Если ничего нет, создаем из описания
-            if not line_level_subtitles:
-                full_text = self.extract_text_from_videos()
-                if full_text:
-                    line_level_subtitles = self.generate_subtitles_from_text(full_text)
-                    print(f"Задача {self.task_id}: Субтитры сгенерированы из описания")
-            
-            self.progress = 70
-            TASKS[self.task_id]["progress"] = self.progress
-            
-            # Шаг 4: Создание финального видео с прокручивающимися субтитрами (30%)
-            final_video_path = self.create_scrolling_subtitles_video(
-                combined_video_path, 
-                word_level_info, 
-                line_level_subtitles,
-                has_audio
-            )
-            
-            if not final_video_path:
-                TASKS[self.task_id]["status"] = "error"
-                TASKS[self.task_id]["error"] = "Failed to create final video with scrolling subtitles."
-                return
+            return stage(*args)
+        except Exception as e:
+            update_task(self.task_id, status="error", error=str(e))
+            logger.exception(f"Критическая ошибка в задаче {self.task_id}: {e}")
+            return None
+
+    # Этапы обработки. Состояние между этапами - JSON-совместимый словарь,
+    # поэтому этапы могут выполняться разными воркерами Celery
+    def download_stage(self):
+        """Этап 1: загрузка видео частей (20%)"""
+        self.progress = 0
+        update_task(self.task_id, status="processing", progress=self.progress)
+        
+        downloaded_files = self.download_video_parts()
+        self.progress = 20
+        update_task(self.task_id, progress=self.progress)
+        
+        return {'downloaded_files': downloaded_files}
+
+    def subtitles_stage(self, state):
+        """Этап 2: объединение частей и подготовка субтитров (70%)"""
+        downloaded_files = state['downloaded_files']
+        
+        # Все части пробуются один раз и параллельно; дальше проверки кодеков и аудио
+        # в обоих потоках берут результат из кэша
+        self.warm_probe_cache(downloaded_files)
+
+        # Объединение частей идет в фоне, пока Whisper читает аудио прямо из частей
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            combine_future = executor.submit(self.combine_downloaded_videos, downloaded_files)
             
-            self.progress = 100
-            TASKS[self.task_id]["progress"] = self.progress
+            # Проверка наличия аудио
+            has_audio = self.sources_have_audio(downloaded_files)
             
-            # Завершение
-            TASKS[self.task_id]["status"] = "completed"
-            TASKS[self.task_id]["output_file"] = final_video_path
-            print(f"Задача {self.task_id} успешно завершена. Файл: {final_video_path}")
+            # Обработка субтитров
+            word_level_info, line_level_subtitles = self.prepare_subtitles(downloaded_files, has_audio)
             
-        except Exception as e:
-            import traceback
-            error_trace = traceback.format_exc()
-            TASKS[self.task_id]["status"] = "error"
-            TASKS[self.task_id]["error"] = str(e)
-            print(f"Критическая ошибка в задаче {self.task_id}: {e}")
-            print(f"DEBUG [{self.task_id}]: Full error traceback: {error_trace}")
+            video_files = combine_future.result()
+        
+        if not video_files:
+            update_task(self.task_id, status="error", error="Failed to download and combine videos.")
+            return None
+        
+        self.progress = 70
+        update_task(self.task_id, progress=self.progress)
+        
+        return {
+            'video_files': video_files,
+            'has_audio': has_audio,
+            'word_level_info': word_level_info,
+            'line_level_subtitles': line_level_subtitles
+        }
+
+    def encode_stage(self, state):
+        """Этап 3: создание финального видео с прокручивающимися субтитрами (100%)"""
+        final_video_path = self.create_scrolling_subtitles_video(
+            state['video_files'], 
+            state['word_level_info'], 
+            state['line_level_subtitles'],
+            state['has_audio']
+        )
+        
+        if not final_video_path:
+            update_task(self.task_id, status="error",
+                        error="Failed to create final video with scrolling subtitles.")
+            return None
+        
+        self.progress = 100
+        update_task(self.task_id, progress=self.progress)
+        
+        # Завершение
+        update_task(self.task_id, status="completed", output_file=final_video_path)
+        logger.info(f"Задача {self.task_id} успешно завершена. Файл: {final_video_path}")
+        return {'output_file': final_video_path}
+
+    def input_params(self):
+        """Параметры входа ffmpeg: аппаратное декодирование при наличии NVENC/NVDEC"""
+        # hwaccel_output_format не задается: фильтры subtitles и concat работают
+        # с кадрами в системной памяти
+        if NVENC_AVAILABLE:
+            return {'hwaccel': 'cuda'}
+        return {}
+
+    def video_encoder_params(self, preset, tune=None):
+        """Параметры кодировщика видео: h264_nvenc на GPU или libx264 на CPU"""
+        if NVENC_AVAILABLE:
+            return {'vcodec': 'h264_nvenc', 'preset': 'p4', 'rc': 'vbr', 'cq': 23, 'threads': FFMPEG_THREADS}
+        params = {'vcodec': 'libx264', 'preset': preset, 'crf': 23, 'threads': FFMPEG_THREADS}
+        if tune:
+            params['tune'] = tune
+        return params
+
+    def _probe(self, path):
+        """ffprobe с кэшированием по пути и времени изменения файла"""
+        key = (path, os.path.getmtime(path))
+        if key not in self._probe_cache:
+            self._probe_cache[key] = ffmpeg.probe(path)
+        return self._probe_cache[key]
+
+    def warm_probe_cache(self, video_files):
+        """Параллельный ffprobe всех файлов для заполнения кэша"""
+        def probe_quietly(video_file):
+            try:
+                self._probe(video_file)
+            except Exception:
+                # Ошибка будет обработана и залогирована при фактической проверке
+                pass
+        
+        if len(video_files) > 1:
+            with ThreadPoolExecutor(max_workers=min(8, len(video_files))) as executor:
+                list(executor.map(probe_quietly, video_files))
 
     def check_audio_exists(self, video_path):
         """Проверка наличия аудиодорожки в видео"""
         try:
-            probe = ffmpeg.probe(video_path)
+            probe = self._probe(video_path)
             return any(stream['codec_type'] == 'audio' for stream in probe.get('streams', []))
         except Exception as e:
-            print(f"Задача {self.task_id}: Ошибка при проверке аудио: {e}")
+            logger.error(f"Задача {self.task_id}: Ошибка при проверке аудио: {e}")
             return False
 
-    def extract_word_timestamps(self, video_path):
+    def prepare_subtitles(self, video_files, has_audio):
+        """Получение субтитров: из аудио (Whisper), из SRT webhook или из описания видео"""
+        word_level_info = None
+        line_level_subtitles = None
+        
+        if has_audio and WHISPER_AVAILABLE:
+            # Извлечение аудио и создание субтитров с временными метками слов
+            word_level_info = self.extract_word_timestamps(video_files)
+            if word_level_info:
+                line_level_subtitles = self.convert_to_line_level(word_level_info)
+                logger.info(f"Задача {self.task_id}: Создано {len(line_level_subtitles)} строк субтитров из аудио")
+        
+        # Если аудио нет или нет word_level_info, используем SRT из webhook
+        if not word_level_info and self.subtitle_cues:
+            line_level_subtitles = self.subtitle_cues
+            logger.info(f"Задача {self.task_id}: Используются субтитры из webhook")
+        
+        # Если ничего нет, создаем из описания
+        if not line_level_subtitles:
+            full_text = self.extract_text_from_videos()
+            if full_text:
+                line_level_subtitles = self.generate_subtitles_from_text(full_text)
+                logger.info(f"Задача {self.task_id}: Субтитры сгенерированы из описания")
+        
+        return word_level_info, line_level_subtitles
+
+    def sources_have_audio(self, video_files):
+        """Проверка наличия аудиодорожки хотя бы в одном из файлов"""
+        return any(self.check_audio_exists(video_file) for video_file in video_files)
+
+    def open_sources(self, video_files, has_audio, include_video=True):
+        """Входные потоки (video, audio) одного файла или склейки нескольких фильтром concat.
+        
+        Склейка выполняется внутри того же вызова ffmpeg, который пишет результат,
+        поэтому промежуточный объединенный файл не создается.
+        """
+        input_kwargs = self.input_params() if include_video else {}
+        inputs = [ffmpeg.input(video_file, **input_kwargs) for video_file in video_files]
+        
+        if len(inputs) == 1:
+            video_stream = inputs[0].video if include_video else None
+            audio_stream = inputs[0].audio if has_audio else None
+            return video_stream, audio_stream
+        
+        # Фильтр concat ожидает потоки в порядке v0, a0, v1, a1, ...
+        concat_streams = []
+        for input_stream in inputs:
+            if include_video:
+                concat_streams.append(input_stream.video)
+            if has_audio:
+                concat_streams.append(input_stream.audio)
+        
+        joined = ffmpeg.concat(*concat_streams, v=int(include_video), a=int(has_audio)).node
+        video_stream = joined[0] if include_video else None
+        audio_stream = joined[int(include_video)] if has_audio else None
+        return video_stream, audio_stream
+
+    def extract_word_timestamps(self, video_files):
         """Извлечение временных меток слов с помощью Whisper"""
         try:
             if not WHISPER_AVAILABLE:
                 return None
                 
-            # Извлечение аудио
-            audio_path = os.path.join(TEMP_DIR, f"audio_{self.task_id}.wav")
-            (ffmpeg
-             .input(video_path)
-             .audio
-             .output(audio_path)
-             .run(overwrite_output=True, capture_stdout=True, capture_stderr=True))
-            
             # Использование Faster Whisper для получения временных меток слов
-            model = WhisperModel("base", device="cpu")
-            segments, info = model.transcribe(audio_path, word_timestamps=True)
-            
+            model = get_whisper_model()
             word_level_info = []
-            for segment in segments:
-                for word in segment.words:
-                    word_level_info.append({
-                        'word': word.word.strip(),
-                        'start': word.start,
-                        'end': word.end
-                    })
             
-            # Очистка временного аудио файла
-            if os.path.exists(audio_path):
-                os.remove(audio_path)
+            # Извлечение аудио напрямую в память (моно, float32), без временного WAV.
+            # Частота берется у модели (16 кГц), чтобы Whisper не передискретизировал сигнал
+            sample_rate = model.feature_extractor.sampling_rate
+            _, audio_stream = self.open_sources(video_files, has_audio=True, include_video=False)
+            out, _ = (ffmpeg
+                      .output(audio_stream, 'pipe:', format='f32le', acodec='pcm_f32le', ac=1, ar=sample_rate,
+                              threads=FFMPEG_THREADS)
+                      .run(capture_stdout=True, capture_stderr=True))
+            audio = np.frombuffer(out, np.float32)
+            
+            # CTranslate2 сам распараллеливает вычисления, поэтому задачи одного
+            # процесса транскрибируют по очереди (процессы воркеров Celery делят
+            # ядра через whisper_cpu_threads); segments - генератор, и распознавание
+            # идет во время итерации, так что она тоже под семафором
+            with _TRANSCRIBE_SEMAPHORE:
+                segments, info = model.transcribe(audio, word_timestamps=True, vad_filter=True)
+                for segment in segments:
+                    for word in segment.words:
+                        word_level_info.append({
+                            'word': word.word.strip(),
+                            'start': word.start,
+                            'end': word.end
+                        })
             
             return word_level_info
             
         except Exception as e:
-            print(f"Задача {self.task_id}: Ошибка извлечения временных меток: {e}")
+            logger.error(f"Задача {self.task_id}: Ошибка извлечения временных меток: {e}")
             return None
 
     def convert_to_line_level(self, word_level_info, max_chars=47):
-        """Конвертация временных меток слов в строки"""
+        """Конвертация временных меток слов в строки.
+        
+        Каждая строка хранит диапазон индексов своих слов в word_level_info
+        (word_start включительно, word_end - нет) для караоке-подсветки.
+        """
         line_level_subtitles = []
         current_line = ""
         line_start = None
         line_end = None
+        line_first_word = 0
         
-        for word_info in word_level_info:
+        for index, word_info in enumerate(word_level_info):
             word = word_info['word'].strip()
             
             if line_start is None:
@@ -221,53 +659,29 @@ class VideoProcessor:
                     line_level_subtitles.append({
                         'text': current_line.strip(),
                         'start': line_start,
-                        'end': line_end
+                        'end': line_end,
+                        'word_start': line_first_word,
+                        'word_end': index
                     })
                 
                 current_line = word + " "
                 line_start = word_info['start']
                 line_end = word_info['end']
+                line_first_word = index
         
         # Добавление последней строки
         if current_line.strip():
             line_level_subtitles.append({
                 'text': current_line.strip(),
                 'start': line_start,
-                'end': line_end
+                'end': line_end,
+                'word_start': line_first_word,
+                'word_end': len(word_level_info)
             })
         
         return line_level_subtitles
 
-    def parse_srt_to_line_level(self, srt_path):
-        """Парсинг SRT файла в формат line_level"""
-        try:
-            line_level_subtitles = []
-            subs = pysrt.open(srt_path)
-            
-            for sub in subs:
-                start_seconds = (sub.start.hours * 3600 + 
-                               sub.start.minutes * 60 + 
-                               sub.start.seconds + 
-                               sub.start.milliseconds / 1000.0)
-                
-                end_seconds = (sub.end.hours * 3600 + 
-                             sub.end.minutes * 60 + 
-                             sub.end.seconds + 
-                             sub.end.milliseconds / 1000.0)
-                
-                line_level_subtitles.append({
-                    'text': sub.text.replace('\n', ' '),
-                    'start': start_seconds,
-                    'end': end_seconds
-                })
-            
-            return line_level_subtitles
-            
-        except Exception as e:
-            print(f"Задача {self.task_id}: Ошибка парсинга SRT: {e}")
-            return None
-
-    def create_scrolling_subtitles_video(self, video_path, word_level_info, line_level_subtitles, has_audio):
+    def create_scrolling_subtitles_video(self, video_files, word_level_info, line_level_subtitles, has_audio):
         """Создание видео с прокручивающимися субтитрами"""
         final_output_path = os.path.join(OUTPUT_DIR, f"final_scrolling_subtitles_{self.task_id}.mp4")
         
@@ -275,26 +689,22 @@ class VideoProcessor:
             # Создание субтитров в формате ASS для прокручивания
             ass_path = self.create_ass_subtitles(word_level_info, line_level_subtitles)
             
-            video_input = ffmpeg.input(video_path)
-            
             if ass_path and os.path.exists(ass_path):
+                video_stream, audio_stream = self.open_sources(video_files, has_audio)
+                
                 # Применение ASS субтитров с прокручиванием
                 video_with_subs = ffmpeg.filter(
-                    video_input.video,
+                    video_stream,
                     'subtitles',
                     ass_path
                 )
                 
                 streams_to_output = [video_with_subs]
                 if has_audio:
-                    streams_to_output.append(video_input.audio)
+                    streams_to_output.append(audio_stream)
                 
-                output_params = {
-                    'vcodec': 'libx264',
-                    'preset': 'medium',
-                    'crf': 23,
-                    'pix_fmt': 'yuv420p'
-                }
+                output_params = self.video_encoder_params('veryfast', tune='fastdecode')
+                output_params['pix_fmt'] = 'yuv420p'
                 
                 if has_audio:
                     output_params['acodec'] = 'aac'
@@ -305,122 +715,106 @@ class VideoProcessor:
                  .run(overwrite_output=True, capture_stdout=True, capture_stderr=True))
             else:
                 # Fallback без субтитров
-                streams_to_output = [video_input.video]
-                if has_audio:
-                    streams_to_output.append(video_input.audio)
-                
-                copy_params = {'vcodec': 'copy'}
-                if has_audio:
-                    copy_params['acodec'] = 'copy'
-                
-                (ffmpeg
-                 .output(*streams_to_output, final_output_path, **copy_params)
-                 .run(overwrite_output=True, capture_stdout=True, capture_stderr=True))
+                self.copy_video_without_subtitles(video_files, final_output_path, has_audio)
             
-            print(f"Задача {self.task_id}: Финальное видео с прокручивающимися субтитрами сохранено в {final_output_path}")
+            logger.info(f"Задача {self.task_id}: Финальное видео с прокручивающимися субтитрами сохранено в {final_output_path}")
             return final_output_path
             
         except ffmpeg.Error as e:
             stderr_output = e.stderr.decode('utf8') if e.stderr else "No stderr"
-            print(f"Задача {self.task_id}: Ошибка FFmpeg: {stderr_output}")
-            return self.create_fallback_video(video_path, line_level_subtitles, has_audio)
+            logger.error(f"Задача {self.task_id}: Ошибка FFmpeg: {stderr_output}")
+            return self.create_fallback_video(video_files, line_level_subtitles, has_audio)
         except Exception as e:
-            print(f"Задача {self.task_id}: Общая ошибка создания видео: {e}")
-            return self.create_fallback_video(video_path, line_level_subtitles, has_audio)
+            logger.error(f"Задача {self.task_id}: Общая ошибка создания видео: {e}")
+            return self.create_fallback_video(video_files, line_level_subtitles, has_audio)
 
     def create_ass_subtitles(self, word_level_info, line_level_subtitles):
         """Создание ASS файла с анимированными субтитрами"""
         try:
             ass_path = os.path.join(TEMP_DIR, f"subtitles_{self.task_id}.ass")
             
-            # ASS заголовок
-            ass_content = """[Script Info]
-Title: Scrolling Subtitles
-ScriptType: v4.00+
-
-[V4+ Styles]
-Format: Name, Fontname, Fontsize, PrimaryColour, SecondaryColour, OutlineColour, BackColour, Bold, Italic, Underline, StrikeOut, ScaleX, ScaleY, Spacing, Angle, BorderStyle, Outline, Shadow, Alignment, MarginL, MarginR, MarginV, Encoding
-Style: Default,Arial,32,&H00FFFFFF,&H000000FF,&H00000000,&H80000000,1,0,0,0,100,100,0,0,1,2,3,2,30,30,50,1
-Style: Highlight,Arial,32,&H0000FFFF,&H000000FF,&H00000000,&H80000000,1,0,0,0,100,100,0,0,1,2,3,2,30,30,50,1
-
-[Events]
-Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
-"""
+            rows = []
             
             if line_level_subtitles:
                 for line in line_level_subtitles:
-                    start_time = self.seconds_to_ass_time(line['start'])
-                    end_time = self.seconds_to_ass_time(line['end'])
-                    
-                    # Добавление основного текста строки
-                    ass_content += f"Dialogue: 0,{start_time},{end_time},Default,,0,0,0,,{line['text']}\n"
+                    # Караоке-подсветка слов одной репликой, если строка собрана из word_level_info
+                    karaoke_text = None
+                    if word_level_info and 'word_start' in line:
+                        karaoke_text = self.create_karaoke_text(
+                            line, word_level_info[line['word_start']:line['word_end']]
+                        )
                     
-                    # Добавление подсветки слов если есть word_level_info
-                    if word_level_info:
-                        self.add_word_highlights(ass_content, line, word_level_info)
+                    if karaoke_text:
+                        rows.append((line['start'], line['end'], 'Karaoke', karaoke_text))
+                    else:
+                        rows.append((line['start'], line['end'], 'Default', line['text']))
+            
+            to_ass_time = self.seconds_to_ass_time
+            events = ''.join(
+                f"Dialogue: 0,{to_ass_time(start)},{to_ass_time(end)},{style},,0,0,0,,{text}\n"
+                for start, end, style, text in rows
+            )
             
             with open(ass_path, 'w', encoding='utf-8') as f:
-                f.write(ass_content)
+                f.write(_ASS_HEADER + events)
             
             return ass_path
             
         except Exception as e:
-            print(f"Задача {self.task_id}: Ошибка создания ASS файла: {e}")
+            logger.error(f"Задача {self.task_id}: Ошибка создания ASS файла: {e}")
             return None
 
     def seconds_to_ass_time(self, seconds):
         """Конвертация секунд в формат времени ASS"""
-        hours = int(seconds // 3600)
-        minutes = int((seconds % 3600) // 60)
-        secs = int(seconds % 60)
-        centiseconds = int((seconds % 1) * 100)
+        # Целочисленная арифметика: float-остаток дает 1.2 -> 1.19
+        total_cs = round(seconds * 100)
+        hours, rest = divmod(total_cs, 360000)
+        minutes, rest = divmod(rest, 6000)
+        secs, centiseconds = divmod(rest, 100)
         return f"{hours:01d}:{minutes:02d}:{secs:02d}.{centiseconds:02d}"
 
-    def add_word_highlights(self, ass_content, line, word_level_info):
-        """Добавление подсветки отдельных слов"""
-        words_in_line = line['text'].split()
+    def create_karaoke_text(self, line, line_words):
+        """Текст строки с тегами \\kf: libass сам подсвечивает слова по их длительности.
         
-        for word_info in word_level_info:
-            word = word_info['word'].strip()
+        line_words - слова, из которых convert_to_line_level собрал строку; возвращает
+        None, если слов нет или они не совпадают с текстом строки.
+        """
+        words = [word_info['word'].strip() for word_info in line_words]
+        if not any(words) or [word for word in words if word] != line['text'].split():
+            return None
+        
+        chunks = []
+        # Длительности считаются от абсолютных позиций в сотых долях секунды,
+        # чтобы ошибки округления не накапливались к концу строки
+        cursor_cs = 0
+        for word_info, word in zip(line_words, words):
+            if not word:
+                continue
             
-            # Проверка, принадлежит ли слово текущей строке
-            if (line['start'] <= word_info['start'] <= line['end'] and 
-                word.lower() in [w.lower() for w in words_in_line]):
-                
-                start_time = self.seconds_to_ass_time(word_info['start'])
-                end_time = self.seconds_to_ass_time(word_info['end'])
-                
-                # Вычисление позиции слова для анимации
-                word_index = next((i for i, w in enumerate(words_in_line) 
-                                 if w.lower() == word.lower()), 0)
-                
-                # Создание эффекта прокручивания для слова
-                highlight_text = self.create_word_highlight_effect(word, word_index, len(words_in_line))
-                
-                ass_content += f"Dialogue: 1,{start_time},{end_time},Highlight,,0,0,0,,{highlight_text}\n"
-
-    def create_word_highlight_effect(self, word, word_index, total_words):
-        """Создание эффекта подсветки для отдельного слова"""
-        # Расчет позиции слова
-        x_offset = (word_index - total_words / 2) * 40  # Приблизительное смещение
+            start_cs = max(cursor_cs, round((word_info['start'] - line['start']) * 100))
+            end_cs = max(start_cs, round((word_info['end'] - line['start']) * 100))
+            
+            # Пауза перед словом
+            if start_cs > cursor_cs:
+                chunks.append(f"{{\\k{start_cs - cursor_cs}}}")
+            chunks.append(f"{{\\kf{end_cs - start_cs}}}{word} ")
+            cursor_cs = end_cs
         
-        # ASS тэги для анимации и позиционирования
-        return f"{{\\pos(960{x_offset:+d},540)\\c&H0000FFFF&\\t(\\c&H00FFFFFF&)}}{word}"
+        return ''.join(chunks).rstrip()
 
-    def create_fallback_video(self, video_path, line_level_subtitles, has_audio):
+    def create_fallback_video(self, video_files, line_level_subtitles, has_audio):
         """Fallback создание видео с простыми субтитрами"""
         try:
             final_output_path = os.path.join(OUTPUT_DIR, f"final_fallback_{self.task_id}.mp4")
             
-            video_input = ffmpeg.input(video_path)
-            
             if line_level_subtitles:
                 # Создание простого SRT файла
                 srt_path = self.create_simple_srt(line_level_subtitles)
                 
                 if srt_path:
+                    video_stream, audio_stream = self.open_sources(video_files, has_audio)
                     processed_video_stream = ffmpeg.filter(
-                        video_input.video, 
+                        video_stream, 
                         'subtitles', 
                         srt_path,
                         force_style='FontName=Arial,FontSize=28,PrimaryColour=&H00FFFFFF,BackColour=&H80000000,BorderStyle=1,Outline=2'
@@ -428,9 +822,9 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                     
                     streams_to_output = [processed_video_stream]
                     if has_audio:
-                        streams_to_output.append(video_input.audio)
+                        streams_to_output.append(audio_stream)
                     
-                    output_params = {'vcodec': 'libx264', 'preset': 'fast', 'crf': 23}
+                    output_params = self.video_encoder_params('fast')
                     if has_audio:
                         output_params['acodec'] = 'aac'
                     
@@ -439,26 +833,33 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                      .run(overwrite_output=True, capture_stdout=True, capture_stderr=True))
                 else:
                     # Копирование без субтитров
-                    self.copy_video_without_subtitles(video_input, final_output_path, has_audio)
+                    self.copy_video_without_subtitles(video_files, final_output_path, has_audio)
             else:
                 # Копирование без субтитров
-                self.copy_video_without_subtitles(video_input, final_output_path, has_audio)
+                self.copy_video_without_subtitles(video_files, final_output_path, has_audio)
             
             return final_output_path
             
         except Exception as e:
-            print(f"Задача {self.task_id}: Ошибка в fallback методе: {e}")
+            logger.error(f"Задача {self.task_id}: Ошибка в fallback методе: {e}")
             raise Exception(f"Критическая ошибка: невозможно создать видео: {e}")
 
-    def copy_video_without_subtitles(self, video_input, output_path, has_audio):
+    def copy_video_without_subtitles(self, video_files, output_path, has_audio):
         """Копирование видео без субтитров"""
-        streams_to_output = [video_input.video]
+        video_stream, audio_stream = self.open_sources(video_files, has_audio)
+        streams_to_output = [video_stream]
         if has_audio:
-            streams_to_output.append(video_input.audio)
+            streams_to_output.append(audio_stream)
         
-        copy_params = {'vcodec': 'copy'}
-        if has_audio:
-            copy_params['acodec'] = 'copy'
+        if len(video_files) == 1:
+            copy_params = {'vcodec': 'copy'}
+            if has_audio:
+                copy_params['acodec'] = 'copy'
+        else:
+            # Склейка фильтром concat требует перекодирования
+            copy_params = self.video_encoder_params('fast')
+            if has_audio:
+                copy_params['acodec'] = 'aac'
         
         (ffmpeg
          .output(*streams_to_output, output_path, **copy_params)
@@ -469,14 +870,11 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
         try:
             srt_path = os.path.join(TEMP_DIR, f"simple_subtitles_{self.task_id}.srt")
             
-            srt_content = ""
-            for i, line in enumerate(line_level_subtitles, 1):
-                start_time = self.format_srt_time(line['start'])
-                end_time = self.format_srt_time(line['end'])
-                
-                srt_content += f"{i}\n"
-                srt_content += f"{start_time} --> {end_time}\n"
-                srt_content += f"{line['text']}\n\n"
+            format_time = self.format_srt_time
+            srt_content = ''.join(
+                f"{i}\n{format_time(line['start'])} --> {format_time(line['end'])}\n{line['text']}\n\n"
+                for i, line in enumerate(line_level_subtitles, 1)
+            )
             
             with open(srt_path, 'w', encoding='utf-8') as f:
                 f.write(srt_content)
@@ -484,33 +882,22 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
             return srt_path
             
         except Exception as e:
-            print(f"Задача {self.task_id}: Ошибка создания SRT: {e}")
+            logger.error(f"Задача {self.task_id}: Ошибка создания SRT: {e}")
             return None
 
     def format_srt_time(self, seconds):
         """Форматирование времени для SRT"""
-        hours = int(seconds // 3600)
-        minutes = int((seconds % 3600) // 60)
-        secs = int(seconds % 60)
-        millisecs = int((seconds % 1) * 1000)
+        total_ms = round(seconds * 1000)
+        hours, rest = divmod(total_ms, 3600000)
+        minutes, rest = divmod(rest, 60000)
+        secs, millisecs = divmod(rest, 1000)
         
         return f"{hours:02d}:{minutes:02d}:{secs:02d},{millisecs:03d}"
 
     # Остальные методы без изменений...
-    def save_subtitles_from_webhook(self, subtitles_content):
-        """Сохранение субтитров, переданных через webhook"""
-        try:
-            srt_path = os.path.join(TEMP_DIR, f"webhook_subtitles_{self.task_id}.srt")
-            with open(srt_path, 'w', encoding='utf-8') as f:
-                f.write(subtitles_content)
-            return srt_path
-        except Exception as e:
-            print(f"Задача {self.task_id}: Ошибка сохранения субтитров из webhook: {e}")
-            return None
-
-    def download_and_combine_videos(self):
-        """Загрузка видео по URL и объединение"""
-        downloaded_files = []
+    def download_video_parts(self):
+        """Загрузка частей видео по URL"""
+        download_jobs = []
         
         for i, video_info in enumerate(self.video_data):
             video_url = self.extract_video_url(video_info)
@@ -521,18 +908,30 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
             filename = f"video_part_{i}_{self.task_id}.mp4"
             local_path = os.path.join(TEMP_DIR, filename)
             xapi_headers = self.prepare_xapi_headers(video_info)
-            
-            print(f"Загрузка видео {i+1}: {video_url}")
-            if self.downloader.download_video(video_url, local_path, xapi_headers):
-                downloaded_files.append(local_path)
-                print(f"Видео {i+1} успешно загружено: {local_path}")
+            download_jobs.append((i, video_url, local_path, xapi_headers))
+        
+        def download_part(job):
+            i, video_url, local_path, xapi_headers = job
+            logger.info(f"Загрузка видео {i+1}: {video_url}")
+            success = self.downloader.download_video(video_url, local_path, xapi_headers)
+            if success:
+                logger.info(f"Видео {i+1} успешно загружено: {local_path}")
             else:
-                print(f"Ошибка загрузки видео {i+1}")
+                logger.error(f"Ошибка загрузки видео {i+1}")
+            return i, success, local_path
+        
+        results = []
+        if download_jobs:
+            # Загрузка частей параллельно; порядок склейки восстанавливается по индексу
+            with ThreadPoolExecutor(max_workers=min(8, len(download_jobs))) as executor:
+                results = list(executor.map(download_part, download_jobs))
+        
+        downloaded_files = [local_path for i, success, local_path in sorted(results) if success]
         
         if not downloaded_files:
             raise Exception("Не удалось загрузить ни одного видео")
             
-        return self.combine_downloaded_videos(downloaded_files)
+        return downloaded_files
 
     def extract_video_url(self, video_info):
         """Извлечение URL видео из данных piapi"""
@@ -555,7 +954,7 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                             elif 'resource' in video_data:
                                 return video_data['resource']
                 except Exception as e:
-                    print(f"DEBUG [{self.task_id}]: Error processing works structure: {e}")
+                    logger.debug(f"Задача {self.task_id}: Ошибка разбора структуры works: {e}")
             
             for key, value in video_info.items():
                 if isinstance(value, str) and value.startswith('http') and '.mp4' in value:
@@ -579,70 +978,82 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
         
         return xapi_headers
 
+    def _stream_signature(self, video_path):
+        """Параметры потоков, которые должны совпадать для склейки без перекодирования"""
+        signature = []
+        for stream in self._probe(video_path).get('streams', []):
+            if stream.get('codec_type') == 'video':
+                signature.append(('video', stream.get('codec_name'), stream.get('profile'),
+                                  stream.get('level'), stream.get('width'), stream.get('height'),
+                                  stream.get('pix_fmt'), stream.get('sample_aspect_ratio'),
+                                  stream.get('r_frame_rate'), stream.get('has_b_frames'),
+                                  stream.get('time_base')))
+            elif stream.get('codec_type') == 'audio':
+                signature.append(('audio', stream.get('codec_name'), stream.get('profile'),
+                                  stream.get('sample_rate'), stream.get('channels'),
+                                  stream.get('time_base')))
+        return tuple(signature)
+
+    def can_stream_copy(self, video_files):
+        """Проверка, что все файлы имеют одинаковые кодеки и параметры потоков"""
+        try:
+            signatures = {self._stream_signature(video_file) for video_file in video_files}
+        except Exception as e:
+            logger.error(f"Задача {self.task_id}: Ошибка при проверке кодеков: {e}")
+            return False
+        return len(signatures) == 1
+
+    def concat_with_stream_copy(self, video_files, combined_path):
+        """Склейка через concat demuxer без декодирования и кодирования"""
+        list_path = os.path.join(TEMP_DIR, f"concat_{self.task_id}.txt")
+        with open(list_path, 'w', encoding='utf-8') as f:
+            for video_file in video_files:
+                escaped_path = os.path.abspath(video_file).replace("'", "'\\''")
+                f.write(f"file '{escaped_path}'\n")
+        
+        try:
+            (ffmpeg
+             .input(list_path, format='concat', safe=0)
+             .output(combined_path, c='copy')
+             .run(overwrite_output=True, capture_stdout=True, capture_stderr=True))
+        finally:
+            if os.path.exists(list_path):
+                os.remove(list_path)
+
     def combine_downloaded_videos(self, video_files):
-        """Объединение загруженных видео файлов"""
+        """Объединение загруженных видео файлов.
+        
+        Возвращает список файлов-источников для следующих шагов: единственную часть
+        без изменений, один объединенный файл, если склейка возможна без
+        перекодирования, иначе сами части - они склеиваются фильтром concat
+        в том же проходе, что и наложение субтитров.
+        """
         if not video_files:
             return None
 
         if len(video_files) == 1:
-            combined_path = os.path.join(TEMP_DIR, f"combined_{self.task_id}.mp4")
-            try:
-                input_stream = ffmpeg.input(video_files[0])
-                has_audio = self.check_audio_exists(video_files[0])
-                
-                output_args = [input_stream.video]
-                output_kwargs = {'vcodec': 'libx264', 'preset': 'fast'}
-                
-                if has_audio:
-                    output_args.append(input_stream.audio)
-                    output_kwargs['acodec'] = 'aac'
-                
-                (ffmpeg
-                 .output(*output_args, combined_path, **output_kwargs)
-                 .run(overwrite_output=True, capture_stdout=True, capture_stderr=True))
-                
-                return combined_path
-            except Exception as e:
-                print(f"Задача {self.task_id}: Ошибка обработки единственного файла: {e}")
-                raise
+            # Единственный файл используется как есть: ни перекодирования, ни копирования
+            return list(video_files)
         
-        # Объединение нескольких файлов
-        inputs = []
-        any_input_has_audio = False
+        combined_path = os.path.join(TEMP_DIR, f"combined_{self.task_id}.mp4")
         
-        for video_file in video_files:
-            if os.path.exists(video_file):
-                inputs.append(ffmpeg.input(video_file))
-                if not any_input_has_audio and self.check_audio_exists(video_file):
-                    any_input_has_audio = True
+        # Объединение нескольких файлов
+        existing_files = [video_file for video_file in video_files if os.path.exists(video_file)]
         
-        if not inputs:
+        if not existing_files:
             return None
         
-        combined_path = os.path.join(TEMP_DIR, f"combined_{self.task_id}.mp4")
-        
-        concat_params = {'n': len(inputs), 'v': 1}
-        if any_input_has_audio:
-            concat_params['a'] = 1
-        else:
-            concat_params['a'] = 0
+        # Одинаковые кодеки: склейка без перекодирования
+        if self.can_stream_copy(existing_files):
+            try:
+                self.concat_with_stream_copy(existing_files, combined_path)
+                return [combined_path]
+            except ffmpeg.Error as e:
+                stderr_output = e.stderr.decode('utf8') if e.stderr else "No stderr"
+                logger.warning(f"Задача {self.task_id}: Склейка без перекодирования не удалась, "
+                               f"части будут склеены при финальном кодировании: {stderr_output}")
         
-        try:
-            joined_streams = ffmpeg.concat(*inputs, **concat_params)
-            
-            output_kwargs = {'vcodec': 'libx264', 'preset': 'fast'}
-            if any_input_has_audio:
-                output_kwargs['acodec'] = 'aac'
-            
-            (ffmpeg
-             .output(joined_streams, combined_path, **output_kwargs)
-             .run(overwrite_output=True, capture_stdout=True, capture_stderr=True))
-            
-            return combined_path
-            
-        except Exception as e:
-            print(f"Задача {self.task_id}: Ошибка объединения видео: {e}")
-            raise
+        return existing_files
 
     def extract_text_from_videos(self):
         """Извлечение текста из описаний видео для генерации субтитров"""
@@ -680,17 +1091,13 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
                 return ""
         
         processed_text = text_input
-        processed_text = re.sub(r'https?://\S+', '', processed_text)
-        
-        tech_terms = ['POV', 'GoPro', 'MacBook', 'LinkedIn', 'TikTok', 'iPhone camera']
-        for term in tech_terms:
-            processed_text = re.sub(r'\b' + re.escape(term) + r'\b', '', processed_text, flags=re.IGNORECASE)
-        
-        processed_text = re.sub(r'realistic and casual.*', '', processed_text, flags=re.IGNORECASE)
-        processed_text = re.sub(r'first person view.*?shot of', 'Видео показывает', processed_text, flags=re.IGNORECASE)
+        processed_text = _URL_RE.sub('', processed_text)
+        processed_text = _TECH_TERMS_RE.sub('', processed_text)
+        processed_text = _REALISTIC_RE.sub('', processed_text)
+        processed_text = _FPV_RE.sub('Видео показывает', processed_text)
         
         processed_text = processed_text.strip()
-        processed_text = re.sub(r'\s+', ' ', processed_text)
+        processed_text = _WS_RE.sub(' ', processed_text)
         
         return processed_text[:500]
 
@@ -716,16 +1123,117 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
         
         return line_level_subtitles
 
-# Flask routes без изменений
+# Не более CONCURRENT_JOBS задач обрабатываются одновременно в одном процессе
+_JOBS_SEMAPHORE = threading.BoundedSemaphore(CONCURRENT_JOBS)
+
+# Число принятых и еще не завершенных задач процесса (без Celery)
+_ACTIVE_JOBS = 0
+_ACTIVE_JOBS_LOCK = threading.Lock()
+
+def run_video_processing(task_id, video_list, subtitle_cues):
+    """Обработка задачи целиком в фоновом потоке"""
+    try:
+        with _JOBS_SEMAPHORE:
+            processor = VideoProcessor(task_id, video_list, subtitle_cues)
+            processor.process_videos()
+    finally:
+        release_job_slot()
+
+def reserve_job_slot():
+    """Резервирование места под новую задачу; False, если очередь заполнена"""
+    global _ACTIVE_JOBS
+    if celery is not None:
+        try:
+            with celery.connection_or_acquire() as conn:
+                depth = conn.default_channel.queue_declare(
+                    queue=celery.conf.task_default_queue, passive=True
+                ).message_count
+        except ChannelError:
+            # Очереди нет (в Redis пустая очередь удаляется) - ожидающих задач нет
+            depth = 0
+        except Exception as e:
+            # Брокер недоступен - прием не блокируется, ошибка проявится при постановке в очередь
+            logger.warning(f"Не удалось получить длину очереди Celery: {e}")
+            return True
+        return depth < MAX_QUEUE
+    
+    with _ACTIVE_JOBS_LOCK:
+        if _ACTIVE_JOBS >= MAX_QUEUE:
+            return False
+        _ACTIVE_JOBS += 1
+        return True
+
+def release_job_slot():
+    """Освобождение места, зарезервированного reserve_job_slot"""
+    global _ACTIVE_JOBS
+    if celery is not None:
+        return
+    with _ACTIVE_JOBS_LOCK:
+        _ACTIVE_JOBS -= 1
+
+if celery is not None:
+    # Воркеры: celery -A main.celery worker (concurrency по умолчанию CONCURRENT_JOBS).
+    # Этапы связаны в chain: пока один воркер кодирует видео, другие уже
+    # загружают части и распознают речь следующих задач. Состояние задачи
+    # все этапы пишут в общее хранилище (Redis)
+    @celery.task(name='video.download')
+    def download_task(task_id, video_list, subtitle_cues):
+        processor = VideoProcessor(task_id, video_list, subtitle_cues)
+        return processor.run_stage(processor.download_stage)
+
+    @celery.task(name='video.subtitles')
+    def subtitles_task(state, task_id, video_list, subtitle_cues):
+        if state is None:
+            return None
+        processor = VideoProcessor(task_id, video_list, subtitle_cues)
+        return processor.run_stage(processor.subtitles_stage, state)
+
+    @celery.task(name='video.encode')
+    def encode_task(state, task_id):
+        # Кодированию достаточно состояния предыдущего этапа: список видео и
+        # реплики SRT через брокер повторно не передаются
+        if state is not None:
+            processor = VideoProcessor(task_id, None)
+            processor.run_stage(processor.encode_stage, state)
+        # Результат последнего этапа (id = task_id) - итоговое состояние задачи
+        return get_task(task_id)
+
+    def enqueue_video_processing(task_id, video_list, subtitle_cues):
+        """Постановка этапов обработки в очередь; последний этап получает id задачи"""
+        return chain(
+            download_task.s(task_id, video_list, subtitle_cues),
+            subtitles_task.s(task_id, video_list, subtitle_cues),
+            encode_task.s(task_id)
+        ).apply_async(task_id=task_id)
+
+def parse_request_json():
+    """Разбор тела запроса без кэширования; orjson, если установлен"""
+    body = request.get_data(cache=False)
+    if ORJSON_AVAILABLE:
+        return orjson.loads(body)
+    return json.loads(body)
+
+# Flask routes
 @app.route('/webhook', methods=['POST'])
 def handle_webhook():
     """Обработчик webhook от n8n для piapi данных с поддержкой субтитров"""
     try:
-        data = request.get_json()
+        try:
+            data = parse_request_json()
+        except RequestEntityTooLarge:
+            return jsonify({
+                "error": "Слишком большой запрос",
+                "status": "error"
+            }), 413
+        except ValueError:
+            return jsonify({
+                "error": "Неверный формат webhook: тело запроса не является JSON",
+                "status": "error"
+            }), 400
         
         # Извлечение данных о видео
         video_list = []
-        subtitles_content = None
+        subtitle_cues = None
         
         if not isinstance(data, dict):
             return jsonify({
@@ -744,10 +1252,26 @@ def handle_webhook():
                 "status": "error"
             }), 400
         
-        # Получение субтитров (опционально)
-        if 'srt' in data:
-            subtitles_content = data['srt']
-            print(f"Получены субтитры для обработки: {len(subtitles_content) if subtitles_content else 0} символов")
+        # Получение субтитров (опционально): SRT разбирается один раз, дальше передаются реплики
+        if data.get('srt'):
+            if not isinstance(data['srt'], str):
+                return jsonify({
+                    "error": "Неверный формат webhook: 'srt' должен быть строкой",
+                    "status": "error"
+                }), 400
+            subtitle_cues = parse_srt_content(data['srt'])
+            if not subtitle_cues:
+                return jsonify({
+                    "error": "Неверный формат SRT: не найдено ни одной реплики",
+                    "status": "error"
+                }), 400
+            for index, cue in enumerate(subtitle_cues, 1):
+                if cue['end'] < cue['start']:
+                    return jsonify({
+                        "error": f"Неверный формат SRT: реплика {index} заканчивается раньше, чем начинается",
+                        "status": "error"
+                    }), 400
+            logger.debug("Получены субтитры для обработки: %d реплик", len(subtitle_cues))
         
         if not video_list:
             return jsonify({
@@ -755,32 +1279,75 @@ def handle_webhook():
                 "status": "error"
             }), 400
         
+        video_count = len(video_list)
+        has_custom_subtitles = bool(subtitle_cues)
+        
         # Генерация task_id
-        task_id = str(uuid.uuid4())
+        task_id = uuid.uuid4().hex
+        
+        # Повтор запроса с тем же Idempotency-Key возвращает уже созданную задачу
+        # (даже при заполненной очереди - новой работы он не добавляет)
+        idempotency_key = request.headers.get('Idempotency-Key')
+        if idempotency_key:
+            existing_task_id = claim_idempotency_key(idempotency_key, task_id)
+            if existing_task_id is not None:
+                existing_task = get_task(existing_task_id) or {}
+                response = jsonify({
+                    "task_id": existing_task_id,
+                    "status": existing_task.get("status", "processing"),
+                    "message": "Задача с этим Idempotency-Key уже создана"
+                })
+                response.status_code = 202
+                response.headers['Location'] = f"/status/{existing_task_id}"
+                return response
+        
+        if not reserve_job_slot():
+            if idempotency_key:
+                release_idempotency_key(idempotency_key, task_id)
+            return jsonify({
+                "error": "Сервер перегружен, повторите запрос позже",
+                "status": "busy"
+            }), 429, {'Retry-After': '30'}
         
         # Инициализация задачи
-        TASKS[task_id] = {
+        task_info = {
             "status": "initiated",
             "progress": 0,
-            "created_at": datetime.now().isoformat(),
+            "created_at": time.time(),
             "video_data": video_list,
-            "video_count": len(video_list),
-            "has_custom_subtitles": bool(subtitles_content)
+            "video_count": video_count,
+            "has_custom_subtitles": has_custom_subtitles
         }
+        try:
+            create_task(task_id, task_info)
+            
+            # Запуск обработки с субтитрами: в очереди Celery или в фоновом потоке
+            if celery is not None:
+                enqueue_video_processing(task_id, video_list, subtitle_cues)
+            else:
+                thread = threading.Thread(
+                    target=run_video_processing,
+                    args=(task_id, video_list, subtitle_cues)
+                )
+                thread.daemon = True
+                thread.start()
+        except Exception:
+            release_job_slot()
+            if idempotency_key:
+                release_idempotency_key(idempotency_key, task_id)
+            raise
         
-        # Запуск обработки с субтитрами
-        processor = VideoProcessor(task_id, video_list, subtitles_content)
-        thread = threading.Thread(target=processor.process_videos)
-        thread.daemon = True
-        thread.start()
-        
-        return jsonify({
+        # Задача принята асинхронно: статус доступен по адресу из Location
+        response = jsonify({
             "task_id": task_id,
             "status": "processing",
-            "message": f"Начата обработка {len(video_list)} видео с прокручивающимися субтитрами",
-            "video_count": len(video_list),
-            "has_custom_subtitles": bool(subtitles_content)
-        }), 200
+            "message": f"Начата обработка {video_count} видео с прокручивающимися субтитрами",
+            "video_count": video_count,
+            "has_custom_subtitles": has_custom_subtitles
+        })
+        response.status_code = 202
+        response.headers['Location'] = f"/status/{task_id}"
+        return response
         
     except Exception as e:
         return jsonify({
@@ -790,15 +1357,28 @@ def handle_webhook():
 
 @app.route('/status/<task_id>', methods=['GET'])
 def get_task_status(task_id):
-    if task_id not in TASKS:
+    # Ответ меняется только вместе со статусом или прогрессом: опрашивающие
+    # клиенты с актуальным ETag получают пустой 304 без чтения всей задачи
+    if request.if_none_match:
+        task_state = get_task_fields(task_id, "status", "progress")
+        if task_state is not None:
+            etag = f'{task_state["status"]}-{task_state["progress"]}'
+            if etag in request.if_none_match:
+                response = make_response('', 304)
+                response.set_etag(etag)
+                response.headers['Cache-Control'] = 'no-cache'
+                return response
+    
+    task_info = get_task(task_id)
+    if task_info is None:
         return jsonify({"error": "Задача не найдена"}), 404
     
-    task_info = TASKS[task_id]
+    etag = f'{task_info["status"]}-{task_info["progress"]}'
     response = {
         "task_id": task_id,
         "status": task_info["status"],
         "progress": task_info["progress"],
-        "created_at": task_info["created_at"],
+        "created_at": datetime.fromtimestamp(task_info["created_at"]).isoformat(),
         "video_count": task_info.get("video_count", 0),
         "has_custom_subtitles": task_info.get("has_custom_subtitles", False)
     }
@@ -813,37 +1393,69 @@ def get_task_status(task_id):
     if "warnings" in task_info:
         response["warnings"] = task_info["warnings"]
     
-    return jsonify(response)
+    response = jsonify(response)
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
 
 @app.route('/download/<task_id>', methods=['GET'])
 def download_video(task_id):
-    if task_id not in TASKS:
+    task_info = get_task(task_id)
+    if task_info is None:
         return jsonify({"error": "Задача не найдена"}), 404
     
-    task_info = TASKS[task_id]
     if task_info["status"] != "completed":
         return jsonify({"error": "Видео еще не готово"}), 400
     
     output_file = task_info.get("output_file", "")
-    if not os.path.exists(output_file):
+    download_name = f"final_scrolling_subtitles_{task_id}.mp4"
+    
+    if X_ACCEL_REDIRECT_PREFIX:
+        if not os.path.isfile(output_file):
+            return jsonify({"error": "Файл не найден"}), 404
+        # Файл отдает nginx через sendfile, воркер Flask освобождается сразу
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = X_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + os.path.basename(output_file)
+        response.headers['Content-Type'] = 'video/mp4'
+        response.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+        response.headers['Cache-Control'] = DOWNLOAD_CACHE_CONTROL
+        return response
+    
+    # Файл открывается сразу, размер и время изменения берутся из fstat открытого
+    # дескриптора: удаление файла после проверки не приводит к ошибке 500
+    try:
+        video_file = open(output_file, 'rb')
+    except FileNotFoundError:
         return jsonify({"error": "Файл не найден"}), 404
+    file_stat = os.fstat(video_file.fileno())
     
-    return send_file(
-        output_file,
-        as_attachment=True,
-        download_name=f"final_scrolling_subtitles_{task_id}.mp4"
+    response = app.response_class(
+        wrap_file(request.environ, video_file),
+        mimetype='video/mp4',
+        direct_passthrough=True
+    )
+    response.content_length = file_stat.st_size
+    response.last_modified = file_stat.st_mtime
+    response.set_etag(str(file_stat.st_mtime_ns))
+    response.headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    response.headers['Cache-Control'] = DOWNLOAD_CACHE_CONTROL
+    # Условные запросы (If-None-Match, Range) обрабатываются по ETag из времени изменения файла
+    return response.make_conditional(request, accept_ranges=True, complete_length=file_stat.st_size)
+
+def log_startup_banner():
+    """Стартовое сообщение сервера (один раз при запуске, вне обработки запросов)"""
+    logger.info(
+        "🎬 Запуск сервера обработки видео с прокручивающимися субтитрами...\n"
+        "📡 Webhook endpoint: http://localhost:9000/webhook\n"
+        "📊 Status endpoint: http://localhost:9000/status/<task_id>\n"
+        "⬇️ Download endpoint: http://localhost:9000/download/<task_id>\n"
+        "📝 Формат webhook с субтитрами:\n"
+        '{"videos": [...], "srt": "1\\n00:00:00,000 --> 00:00:03,000\\nПервая строка субтитров\\n\\n2\\n00:00:03,000 --> 00:00:06,000\\nВторая строка субтитров"}\n'
+        "🔧 Для полной функциональности установите:\n"
+        "pip install faster-whisper openai-whisper moviepy flask ffmpeg-python requests"
     )
 
 if __name__ == '__main__':
-    print("🎬 Запуск сервера обработки видео с прокручивающимися субтитрами...")
-    print("📡 Webhook endpoint: http://localhost:9000/webhook")
-    print("📊 Status endpoint: http://localhost:9000/status/<task_id>")
-    print("⬇️ Download endpoint: http://localhost:9000/download/<task_id>")
-    print("\n📝 Формат webhook с субтитрами:")
-    print('{"videos": [...], "srt": "1\\n00:00:00,000 --> 00:00:03,000\\nПервая строка субтитров\\n\\n2\\n00:00:03,000 --> 00:00:06,000\\nВторая строка субтитров"}')
-    
-    # Установка зависимостей
-    print("\n🔧 Для полной функциональности установите:")
-    print("pip install faster-whisper openai-whisper moviepy flask ffmpeg-python pysrt requests")
-    
-    app.run(host='0.0.0.0', port=9000, debug=True)
+    if DEBUG:
+        log_startup_banner()
+    app.run(host='0.0.0.0', port=9000, debug=DEBUG, threaded=True)